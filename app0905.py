@@ -1,17 +1,19 @@
 import streamlit as st
-import yfinance as yf
 import pandas as pd
-import plotly.express as px
 from dotenv import load_dotenv
 import os
-from datetime import datetime, timedelta, timezone # 修正 3: 匯入 timezone
+from datetime import date, datetime, timedelta, timezone # 修正 3: 匯入 timezone
 import numpy as np
 import json
 import requests
+import ijson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
+import hmac
+from concurrent.futures import ThreadPoolExecutor
 import gspread
-from gspread_dataframe import get_as_dataframe, set_with_dataframe
-import time # 修正 2: 匯入 time 模組用於重試等待
+from gspread_dataframe import get_as_dataframe
 
 # --- 頁面設定 ---
 st.set_page_config(page_title="美股智能投顧", layout="wide")
@@ -24,81 +26,246 @@ def connect_to_gsheets():
         gc = gspread.service_account_from_dict(creds)
         spreadsheet_url = st.secrets["gspread_spreadsheet"]["url"]
         sh = gc.open_by_url(spreadsheet_url)
-        return sh
+        # 工作表 handle 與連線一起快取，並以單次 API 呼叫取得所有工作表，避免每次 rerun 都重新查詢 metadata
+        worksheets = {ws.title: ws for ws in sh.worksheets()}
+        missing = [name for name in ("users", "recommendations") if name not in worksheets]
+        if missing:
+            st.error(f"找不到名為 {', '.join(repr(name) for name in missing)} 的工作表，請檢查您的 Google Sheet 設定。")
+            return None, {}
+        return sh, worksheets
     except Exception as e:
         st.error(f"無法連接到 Google Sheets，請檢查您的 secrets 設定: {e}")
-        return None
+        return None, {}
+
+spreadsheet, worksheets = connect_to_gsheets()
+
+# --- 環境變數與 API 金鑰：Streamlit 每次 rerun 都會重新執行整個腳本，因此以 cache_resource 確保只讀取一次 ---
+@st.cache_resource
+def load_gemini_api_key():
+    load_dotenv()
+    return os.getenv("GEMINI_API_KEY") or st.secrets.get("GEMINI_API_KEY")
 
-spreadsheet = connect_to_gsheets()
+_GEMINI_KEY = load_gemini_api_key()
 
-# --- 修正 2: 加入自動重試機制的 Gemini API 函數 ---
-def get_gemini_recommendation(prompt, api_key):
-    """發送請求到 Gemini API，並加入自動重試機制。"""
+# --- Gemini API 連線：共用 Session 重複使用 TCP/TLS 連線，並由 Retry 處理自動重試 ---
+@st.cache_resource
+def create_http_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(["POST"]), # 預設不重試 POST，需明確允許
+        ),
+    ))
+    return session
+
+_SESSION = create_http_session()
+
+_GEMINI_GEN_CONFIG = {"temperature": 0.5, "topK": 1, "topP": 1, "maxOutputTokens": 4096}
+
+# 投資組合推薦的 Prompt 模板；固定的模板字串讓相同的使用者資料產生相同的 prompt，可作為快取鍵
+_PROMPT_TMPL = """
+作為一名專業的財富顧問，請根據以下使用者資料，為一位投資新手推薦3到5個在美國市場的投資標的（可以是股票或ETF）。
+您的推薦需要考慮到風險分散、使用者的財務狀況與風險偏好。
+
+使用者資料:
+- 職業: {profession}
+- 月薪範圍: {monthly_salary} (台幣)
+- 負債範圍: {debt} (台幣)
+- 年齡範圍: {age_range}
+- 風險偏好: {risk_tolerance}
+- 投資經驗: {investment_experience}
+
+請回傳符合指定 schema 的 JSON，不要有任何多餘的文字或解釋:
+- reason: 用繁體中文，不超過150字，簡潔地解釋為什麼推薦這個組合
+- tickers: 股票代碼陣列，例如：["VOO", "AAPL", "MSFT"]
+- weights: 與 tickers 一一對應的投資比例陣列，總和必須為1，例如：[0.6, 0.2, 0.2]
+"""
+
+# 投資組合推薦的結構化輸出格式，由 Gemini 直接回傳符合此 schema 的 JSON
+RECOMMENDATION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "reason": {"type": "STRING"},
+        "tickers": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "weights": {"type": "ARRAY", "items": {"type": "NUMBER"}},
+    },
+    "required": ["reason", "tickers", "weights"],
+}
+
+class _GeminiCallFailed(Exception):
+    """Gemini 呼叫失敗，訊息為要顯示給使用者的說明；以例外回報也讓 st.cache_data 不會快取失敗結果。"""
+
+def _gemini_call_uncached(prompt, api_key, response_schema=None):
+    """發送請求到 Gemini API，失敗時由連線層自動以指數退避重試。
+
+    若提供 response_schema，則要求 Gemini 回傳符合該 schema 的 JSON 字串。
+    不呼叫任何 st.* 函數（可能在背景執行緒中執行），失敗時拋出 _GeminiCallFailed。
+    """
     url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-05-20:generateContent?key={api_key}"
     headers = {'Content-Type': 'application/json'}
+    generation_config = _GEMINI_GEN_CONFIG
+    if response_schema is not None:
+        generation_config = {**_GEMINI_GEN_CONFIG, "responseMimeType": "application/json", "responseSchema": response_schema}
     data = {
         "contents": [{"parts": [{"text": prompt}]}],
-        "generationConfig": {"temperature": 0.5, "topK": 1, "topP": 1, "maxOutputTokens": 4096}
+        "generationConfig": generation_config
     }
-    
-    max_retries = 3
-    backoff_factor = 1.0 # 初始等待秒數
 
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=headers, json=data, timeout=60) # 增加超時設定
+    # 以串流方式逐塊解析回應，只保留第一段文字，不在記憶體中建立完整的 JSON 樹。
+    # 透過 iter_content 讀完整個 body：連線才能歸還連線池，讀取中途的網路錯誤也會包裝成 RequestException。
+    text, finish_reason = None, None
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+    def _consume_events():
+        nonlocal text, finish_reason
+        for prefix, _, value in events:
+            if text is None and prefix == 'candidates.item.content.parts.item.text':
+                text = value
+            elif finish_reason is None and prefix == 'candidates.item.finishReason':
+                finish_reason = value
+        del events[:]
+    try:
+        with _SESSION.post(url, headers=headers, json=data, timeout=60, stream=True) as response: # 增加超時設定
             response.raise_for_status() # 如果是 4xx 或 5xx 錯誤，會拋出異常
-            
-            result = response.json()
-            candidates = result.get("candidates")
-            if not candidates:
-                st.error("AI 回應中找不到 'candidates'。")
-                st.json(result)
-                return None
-            
-            content = candidates[0].get("content")
-            if not content:
-                finish_reason = candidates[0].get("finishReason", "未知")
-                st.error(f"AI 回應因 '{finish_reason}' 而不完整，找不到 'content'。")
-                st.json(result)
-                return None
-            
-            parts = content.get("parts")
-            if not parts:
-                st.error("AI 回應中找不到 'parts'，內容可能為空。")
-                st.json(result)
-                return None
-            
-            return parts[0]['text'] # 成功後直接返回
-
-        except requests.exceptions.RequestException as e:
-            st.warning(f"呼叫 Gemini API 發生網路錯誤 (第 {attempt + 1} 次嘗試): {e}")
-            if attempt < max_retries - 1:
-                wait_time = backoff_factor * (2 ** attempt)
-                st.info(f"將在 {wait_time:.1f} 秒後重試...")
-                time.sleep(wait_time)
-            else:
-                st.error("已達最大重試次數，API 呼叫失敗。")
-                return None
-    return None # 如果迴圈結束仍未成功
+            for chunk in response.iter_content(chunk_size=8192):
+                parser.send(chunk)
+                _consume_events()
+        parser.close()
+        _consume_events()
+    except requests.exceptions.RequestException as e:
+        raise _GeminiCallFailed(f"呼叫 Gemini API 失敗（已自動重試）: {e}")
+    except ijson.JSONError as e:
+        raise _GeminiCallFailed(f"無法解析 AI 回應: {e}")
+
+    if text is None:
+        raise _GeminiCallFailed(f"AI 回應因 '{finish_reason or '未知'}' 而不完整，找不到文字內容。")
+    return text
+
+def _check_structured_reply(text, response_schema):
+    """確認結構化回應可用；截斷或不完整的 JSON 會拋出 _GeminiCallFailed，避免被快取。"""
+    try:
+        reply = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise _GeminiCallFailed(f"AI 回應不是完整的 JSON（可能因長度限制被截斷）: {e}")
+    missing = [key for key in response_schema.get("required", []) if not isinstance(reply, dict) or key not in reply]
+    if missing:
+        raise _GeminiCallFailed(f"AI 回應缺少必要欄位: {', '.join(missing)}")
+    if 'tickers' in reply and 'weights' in reply:
+        tickers, weights = reply['tickers'], reply['weights']
+        if not isinstance(tickers, list) or not isinstance(weights, list) or not tickers or len(tickers) != len(weights):
+            raise _GeminiCallFailed("AI 回應的股票代碼與投資比例數量不一致。")
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def _gemini_call_cached(prompt, api_key, response_schema=None):
+    text = _gemini_call_uncached(prompt, api_key, response_schema)
+    if response_schema is not None:
+        _check_structured_reply(text, response_schema) # 只快取可用的回應，無效時下次點擊會重新呼叫
+    return text
+
+def get_gemini_recommendation(prompt, api_key, response_schema=None):
+    """以 prompt 內容為快取鍵的 Gemini 呼叫：相同的 prompt 一天內直接回傳快取結果，失敗時回傳 None。"""
+    try:
+        return _gemini_call_cached(prompt, api_key, response_schema)
+    except _GeminiCallFailed as e:
+        st.error(str(e))
+        return None
 
 # --- 使用者身份驗證輔助函數 ---
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def get_users_df():
+# scrypt 參數：n=2**15, r=8 約需 32 MiB 記憶體，超過 OpenSSL 預設上限，因此放寬 maxmem
+_SCRYPT_PARAMS = {"n": 2**15, "r": 8, "p": 1, "dklen": 32, "maxmem": 64 * 1024 * 1024}
+
+def hash_password(password, salt=None):
+    """以加鹽的 scrypt 雜湊密碼，回傳 'salt$hexdigest' 格式字串。"""
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, **_SCRYPT_PARAMS)
+    return f"{salt.hex()}${digest.hex()}"
+
+def is_legacy_hash(stored_hash):
+    """舊版紀錄為未加鹽的 SHA-256，不含 '$' 分隔符號。"""
+    return '$' not in stored_hash
+
+def verify_password(password, stored_hash):
+    """以固定時間比較驗證密碼，同時相容舊版 SHA-256 雜湊。"""
+    if is_legacy_hash(stored_hash):
+        computed = hashlib.sha256(password.encode()).hexdigest()
+    else:
+        try:
+            salt = bytes.fromhex(stored_hash.split('$', 1)[0])
+        except ValueError:
+            return False
+        computed = hash_password(password, salt)
+    return hmac.compare_digest(computed, stored_hash)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _load_sheet_df(sheet_name: str):
+    """讀取整張工作表並快取 60 秒，避免每次 rerun 都呼叫 Sheets API。
+
+    回傳前統一轉為字串（空白儲存格為 ''），呼叫端不需再各自轉型。
+    """
+    return get_as_dataframe(worksheets[sheet_name], evaluate_formulas=True).fillna('').astype(str)
+
+@st.cache_resource(ttl=60, show_spinner=False)
+def _users_by_email():
+    """建立 {email: (hashed_password, display_name)} 索引，登入時以 O(1) 查詢取代整欄比對。
+
+    以 cache_resource 快取，每次呼叫回傳同一個 dict 而不經反序列化複製；呼叫端只讀取，不可修改。
+    """
+    df = _load_sheet_df("users")
+    df = df[df['email'] != '']
+    return dict(zip(df['email'], zip(df['hashed_password'], df['display_name'])))
+
+def get_user_record(email):
     try:
-        users_ws = spreadsheet.worksheet("users")
-        df = get_as_dataframe(users_ws, evaluate_formulas=True)
-        if not df.empty:
-            df = df.astype(str)
-        return df
-    except gspread.WorksheetNotFound:
-        st.error("找不到名為 'users' 的工作表，請檢查您的 Google Sheet 設定。")
-        return pd.DataFrame()
+        return _users_by_email().get(email)
     except Exception as e:
         st.error(f"讀取使用者資料時發生錯誤: {e}")
-        return pd.DataFrame()
+        return None
+
+def clear_users_cache():
+    _load_sheet_df.clear()
+    _users_by_email.clear()
+
+def upgrade_password_hash(email, password):
+    """登入成功後，將舊版 SHA-256 雜湊改寫為 scrypt 雜湊。"""
+    try:
+        users_ws = worksheets["users"]
+        columns = users_ws.row_values(1)
+        cell = users_ws.find(email, in_column=columns.index('email') + 1)
+        if cell is None:
+            return
+        users_ws.update_cell(cell.row, columns.index('hashed_password') + 1, hash_password(password))
+        clear_users_cache()
+    except Exception as e:
+        st.warning(f"更新密碼雜湊格式時發生錯誤: {e}")
+
+# --- 推薦紀錄讀取 ---
+REC_COLUMNS = ['timestamp', 'user_email', 'tickers', 'weights', 'reason']
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _load_user_recs_df(user_email: str):
+    """只抓取指定使用者的推薦紀錄，而不是下載整張工作表再過濾。
+
+    先只讀取 user_email 這一欄找出符合的列號，再以單次 batch_get 取回那些列。
+    """
+    recs_ws = worksheets["recommendations"]
+    emails = recs_ws.col_values(REC_COLUMNS.index('user_email') + 1)
+    rows = [row for row, value in enumerate(emails, start=1) if row > 1 and value == user_email]
+    if not rows:
+        return pd.DataFrame(columns=REC_COLUMNS)
+    last_col = chr(ord('A') + len(REC_COLUMNS) - 1)
+    ranges = recs_ws.batch_get([f"A{r}:{last_col}{r}" for r in rows])
+    records = []
+    for value_range in ranges:
+        row = list(value_range[0]) if value_range else []
+        records.append(row + [''] * (len(REC_COLUMNS) - len(row))) # 補齊尾端空白欄位
+    # batch_get 回傳的值皆為字串，不需再轉型；排序也在快取內完成，rerun 時不必重做
+    return pd.DataFrame(records, columns=REC_COLUMNS).sort_values(by='timestamp', ascending=False, ignore_index=True)
 
 # --- 頁面邏輯 ---
 if 'user' not in st.session_state:
@@ -122,10 +289,12 @@ def page_login():
             password = st.text_input("密碼", type="password")
             submit_button = st.form_submit_button("登入")
             if submit_button:
-                users_df = get_users_df()
-                user_record = users_df[users_df['email'] == email]
-                if not user_record.empty and hash_password(password) == user_record.iloc[0]['hashed_password']:
-                    st.session_state['user'] = user_record.iloc[0].to_dict()
+                user_record = get_user_record(email)
+                if user_record and verify_password(password, user_record[0]):
+                    hashed_password, display_name = user_record
+                    if is_legacy_hash(hashed_password):
+                        upgrade_password_hash(email, password)
+                    st.session_state['user'] = {'email': email, 'hashed_password': hashed_password, 'display_name': display_name}
                     st.session_state['page'] = '主頁'
                     st.success(f"歡迎回來, {st.session_state['user']['display_name']}！")
                     st.rerun()
@@ -138,14 +307,18 @@ def page_login():
             display_name = st.text_input("暱稱")
             submit_button = st.form_submit_button("註冊")
             if submit_button:
-                users_df = get_users_df()
-                if email in users_df['email'].values:
+                try:
+                    is_registered = email in _users_by_email()
+                except Exception as e:
+                    st.error(f"讀取使用者資料時發生錯誤: {e}")
+                    return
+                if is_registered:
                     st.error("此電子郵件已被註冊。")
                 else:
-                    new_user_data = pd.DataFrame([[email, hash_password(password), display_name]], columns=users_df.columns)
-                    updated_df = pd.concat([users_df, new_user_data], ignore_index=True)
                     try:
-                        set_with_dataframe(spreadsheet.worksheet("users"), updated_df)
+                        # 直接附加一列，避免每次註冊都讀取並覆寫整張工作表
+                        worksheets["users"].append_row([email, hash_password(password), display_name], value_input_option='RAW')
+                        clear_users_cache()
                         st.success("註冊成功！請前往登入頁面登入。")
                     except Exception as e:
                         st.error(f"寫入使用者資料時發生錯誤: {e}")
@@ -161,8 +334,7 @@ def page_main():
     st.title("📈 美股智能投顧")
     st.caption("AI 模型版本: Google Gemini `gemini-2.5-flash-preview-05-20`")
 
-    load_dotenv()
-    gemini_api_key = os.getenv("GEMINI_API_KEY") or st.secrets.get("GEMINI_API_KEY")
+    gemini_api_key = _GEMINI_KEY
     if not gemini_api_key:
         st.error("偵測不到 GEMINI_API_KEY！請在 .env 檔案或 Streamlit Secrets 中設定。")
         return
@@ -189,36 +361,23 @@ def page_main():
         st.header("獲取您的專屬投資組合")
         if st.button("🚀 開始分析"):
             with st.spinner("AI 正在為您客製化分析中..."):
-                # ... (Prompt 內容不變)
-                prompt = f"""
-                作為一名專業的財富顧問，請根據以下使用者資料，為一位投資新手推薦3到5個在美國市場的投資標的（可以是股票或ETF）。
-                您的推薦需要考慮到風險分散、使用者的財務狀況與風險偏好。
-
-                使用者資料:
-                - 職業: {profession}
-                - 月薪範圍: {monthly_salary} (台幣)
-                - 負債範圍: {debt} (台幣)
-                - 年齡範圍: {age_range}
-                - 風險偏好: {risk_tolerance}
-                - 投資經驗: {investment_experience}
-
-                請嚴格按照以下格式回覆，不要有任何多餘的文字或解釋:
-                [START]
-                推薦理由: [在這裡用繁體中文，不超過150字，簡潔地解釋為什麼推薦這個組合]
-                股票代碼: [以逗號分隔的股票代碼，例如：VOO,AAPL,MSFT]
-                投資比例: [以逗號分隔的數字，總和必須為1，例如：0.6,0.2,0.2]
-                [END]
-                """
-                response_content = get_gemini_recommendation(prompt, gemini_api_key)
+                prompt = _PROMPT_TMPL.format_map({
+                    'profession': profession,
+                    'monthly_salary': monthly_salary,
+                    'debt': debt,
+                    'age_range': age_range,
+                    'risk_tolerance': risk_tolerance,
+                    'investment_experience': investment_experience,
+                })
+                response_content = get_gemini_recommendation(prompt, gemini_api_key, response_schema=RECOMMENDATION_SCHEMA)
                 if response_content:
                     st.write("---")
                     st.subheader("🤖 AI 客製化推薦")
                     try:
-                        content = response_content.split("[START]")[1].split("[END]")[0].strip()
-                        lines = content.split('\n')
-                        reason = lines[0].replace("推薦理由: ", "").strip()
-                        tickers = [t.strip() for t in lines[1].replace("股票代碼: ", "").split(",")]
-                        weights = [float(w.strip()) for w in lines[2].replace("投資比例: ", "").split(",")]
+                        recommendation = json.loads(response_content)
+                        reason = recommendation['reason'].strip()
+                        tickers = [t.strip() for t in recommendation['tickers']]
+                        weights = [float(w) for w in recommendation['weights']]
 
                         st.info(f"**AI 推薦理由：** {reason}")
                         display_portfolio_performance(tickers, weights, gemini_api_key)
@@ -227,17 +386,16 @@ def page_main():
                         tw_timezone = timezone(timedelta(hours=8))
                         tw_time = datetime.now(tw_timezone).strftime("%Y-%m-%d %H:%M:%S")
 
-                        recs_ws = spreadsheet.worksheet("recommendations")
-                        recs_df = get_as_dataframe(recs_ws).astype(str)
-                        new_rec = pd.DataFrame([{
-                            'timestamp': tw_time,
-                            'user_email': st.session_state.user['email'],
-                            'tickers': ','.join(tickers),
-                            'weights': ','.join(map(str, weights)),
-                            'reason': reason
-                        }])
-                        updated_df = pd.concat([recs_df, new_rec], ignore_index=True)
-                        set_with_dataframe(recs_ws, updated_df)
+                        # 直接附加一列，避免每次都讀取並覆寫整張工作表
+                        recs_ws = worksheets["recommendations"]
+                        recs_ws.append_row([
+                            tw_time,
+                            st.session_state.user['email'],
+                            ','.join(tickers),
+                            ','.join(map(str, weights)),
+                            reason
+                        ], value_input_option='RAW')
+                        _load_user_recs_df.clear()
                         st.success("這次的推薦已成功儲存！您可以在「歷史推薦績效」分頁查看。")
 
                     except Exception as e:
@@ -246,18 +404,35 @@ def page_main():
 
     with tab2:
         st.header("查看您過去的 AI 推薦與即時績效")
-        recs_ws = spreadsheet.worksheet("recommendations")
-        all_recs_df = get_as_dataframe(recs_ws).astype(str)
-        user_recs_df = all_recs_df[all_recs_df['user_email'] == st.session_state.user['email']].sort_values(by='timestamp', ascending=False)
+        user_recs_df = _load_user_recs_df(st.session_state.user['email'])
         if user_recs_df.empty:
             st.info("您目前沒有任何歷史推薦紀錄。")
         else:
-            for i, rec in user_recs_df.iterrows():
-                with st.expander(f"**{rec['timestamp']}** 的推薦組合：`{rec['tickers']}`"):
-                    st.info(f"**當時的推薦理由：** {rec['reason']}")
-                    tickers = rec['tickers'].split(',')
-                    weights = [float(w) for w in rec['weights'].split(',')]
-                    display_portfolio_performance(tickers, weights, gemini_api_key, is_historical=True)
+            # 以單一表格列出所有紀錄，只為被選取的那一筆計算並繪製績效，而不是每筆紀錄各建一個 expander
+            event = st.dataframe(
+                user_recs_df[['timestamp', 'tickers', 'weights', 'reason']].rename(columns={
+                    'timestamp': '推薦時間', 'tickers': '股票代碼', 'weights': '投資比例', 'reason': '推薦理由'
+                }),
+                on_select="rerun",
+                selection_mode="single-row",
+                hide_index=True,
+                use_container_width=True,
+            )
+            # 不指定 key：表格身分隨資料而變，新增紀錄後選取狀態會重置，不會指向另一筆紀錄
+            selected_rows = [row for row in event.selection.rows if row < len(user_recs_df)]
+            if not selected_rows:
+                st.caption("點選表格中的一筆紀錄，即可查看該組合的即時績效與風險預測。")
+            else:
+                rec = user_recs_df.iloc[selected_rows[0]]
+                # 一次下載所有歷史推薦涉及的標的，切換選取的紀錄時可直接命中快取
+                all_tickers = sorted({t for row in user_recs_df['tickers'] for t in row.split(',')})
+                start_date, end_date = get_backtest_window()
+                prices_df = _fetch_prices(tuple(all_tickers), start_date, end_date)
+                st.subheader(f"{rec['timestamp']} 的推薦組合：`{rec['tickers']}`")
+                st.info(f"**當時的推薦理由：** {rec['reason']}")
+                tickers = rec['tickers'].split(',')
+                weights = np.fromstring(rec['weights'], sep=',')
+                display_portfolio_performance(tickers, weights, gemini_api_key, is_historical=True, prices_df=prices_df)
 
     with tab3: # 一站式開戶 (內容不變)
         st.header("🇹🇼 投資美股第一步：選擇適合的台灣券商")
@@ -383,74 +558,148 @@ def page_main():
             """)
 
 # --- 績效與風險預測函數 ---
-def display_portfolio_performance(tickers, weights, api_key, is_historical=False):
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_prices(tickers_tuple: tuple, start: date, end: date) -> pd.DataFrame:
+    """下載收盤價並快取一小時；以日期為粒度，同一天內的 rerun 都能命中快取。"""
+    import yfinance as yf # 延遲匯入：登入頁不需要 yfinance，縮短冷啟動時間
+    prices = yf.download(list(tickers_tuple), start=start, end=end, auto_adjust=True, progress=False, threads=True)["Close"] # threads=True 讓 yfinance 平行下載各標的
+    if isinstance(prices, pd.Series):
+        prices = prices.to_frame(name=tickers_tuple[0])
+    return prices
+
+def get_backtest_window():
+    """回測區間：今天往前推兩年。"""
+    end_date = date.today()
+    return end_date - timedelta(days=2*365), end_date
+
+MC_SIMULATIONS, MC_YEARS, MC_INITIAL_INVESTMENT = 1000, 10, 10000
+RNG = np.random.default_rng() # PCG64 產生器，比舊版 np.random 全域狀態更快
+
+def simulate_final_values(portfolio_returns):
+    """以歷史日報酬的平均與標準差模擬 MC_YEARS 年後的投資終值。
+
+    只需要終值分佈：對數報酬可加，T 日累積對數報酬近似 Normal(μ·T, σ²·T)，
+    因此每次模擬只需抽一個常態亂數，不必逐日模擬整條路徑。
+    """
+    T = 252 * MC_YEARS
+    mu, sigma = portfolio_returns.mean(), portfolio_returns.std(ddof=1)
+    # 將簡單報酬的動差換算為對數報酬的動差
+    log_mu = np.log1p(mu) - 0.5 * sigma**2 / (1 + mu)**2
+    log_sigma = sigma / (1 + mu)
+    terminal_log = RNG.standard_normal(MC_SIMULATIONS) * (log_sigma * np.sqrt(T)) + log_mu * T
+    return MC_INITIAL_INVESTMENT * np.exp(terminal_log)
+
+@st.cache_data(ttl=1800, show_spinner=False)
+def _compute_portfolio(tickers: tuple, weights: tuple, start_date: date, end_date: date, _prices_df=None):
+    """績效與模擬的純計算部分，以 (tickers, weights, 回測區間) 為快取鍵。
+
+    _prices_df 為可選的預先下載價格（參數名稱以底線開頭，不列入快取鍵）。
+    資料不足時回傳 {'warning': 訊息}。
+    """
+    # 排序後的 tuple 作為穩定的快取鍵，再依原始順序取欄位，確保與 weights 對齊
+    if _prices_df is None:
+        _prices_df = _fetch_prices(tuple(sorted(tickers)), start_date, end_date)
+    rec_data = _prices_df.reindex(columns=list(tickers)).dropna(how='all')
+    if rec_data.empty:
+        return {'warning': "⚠️ 在指定日期範圍內找不到有效的歷史數據。"}
+    missing_tickers = rec_data.columns[rec_data.isna().all()].tolist()
+    if missing_tickers:
+        return {'warning': f"⚠️ 找不到以下標的的歷史數據：{', '.join(missing_tickers)}"}
+    rec_data = rec_data.ffill().bfill() # 每欄至少有一筆數據，填補後不會再有缺值
+
+    prices = rec_data.to_numpy()
+    normalized_data = pd.DataFrame(prices / prices[0], index=rec_data.index, columns=rec_data.columns) # 直接以 NumPy 廣播，省去 pandas 標籤對齊
+
+    # 以 NumPy 陣列計算報酬，權重以單次矩陣向量乘法加總，不產生中間 DataFrame
+    returns = np.diff(prices, axis=0) / prices[:-1]
+    portfolio_returns = returns @ np.asarray(weights, dtype=returns.dtype)
+    cumulative = np.cumprod(1 + portfolio_returns)
+
+    # 績效指標直接以 NumPy 陣列計算，pandas Series 只用於繪圖
+    total_return = float(cumulative[-1] - 1)
+    annual_return = total_return / 2 
+    annual_volatility = float(np.std(portfolio_returns, ddof=1) * np.sqrt(252))
+    sharpe_ratio = (annual_return - 0.02) / annual_volatility if annual_volatility != 0 else 0
+
+    final_values = simulate_final_values(portfolio_returns)
+    return {
+        'normalized_data': normalized_data,
+        'cumulative_returns': pd.Series(cumulative, index=rec_data.index[1:]),
+        'total_return': total_return,
+        'annual_return': annual_return,
+        'annual_volatility': annual_volatility,
+        'sharpe_ratio': sharpe_ratio,
+        'final_values': final_values,
+        'percentiles': np.percentile(final_values, [5, 50, 95]),
+    }
+
+def display_portfolio_performance(tickers, weights, api_key, is_historical=False, prices_df=None):
+    import plotly.express as px # 延遲匯入：登入頁不需要 plotly
     try:
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=2*365)
+        start_date, end_date = get_backtest_window()
         title_prefix = "歷史推薦組合" if is_historical else "AI 推薦組合"
         subheader_title = f"📈 {title_prefix} - 標的歷史績效 (回測區間: {start_date.strftime('%Y-%m-%d')} ~ {end_date.strftime('%Y-%m-%d')})"
-        
-        rec_data = yf.download(tickers, start=start_date, end=end_date, auto_adjust=True)["Close"]
-        if isinstance(rec_data, pd.Series):
-            rec_data = rec_data.to_frame(name=tickers[0])
-        if rec_data.empty:
-            st.warning("⚠️ 在指定日期範圍內找不到有效的歷史數據。")
+
+        with st.spinner("正在計算績效並執行 1,000 次未來情境模擬..."):
+            result = _compute_portfolio(tuple(tickers), tuple(weights), start_date, end_date, _prices_df=prices_df)
+        if 'warning' in result:
+            st.warning(result['warning'])
             return
 
         st.subheader(subheader_title)
-        normalized_data = (rec_data / rec_data.iloc[0])
-        st.plotly_chart(px.line(normalized_data, title=f"{title_prefix} - 價格走勢 (標準化)"), use_container_width=True)
-        
-        returns = rec_data.pct_change().dropna()
-        portfolio_returns = (returns * weights).sum(axis=1)
-        cumulative_returns = (1 + portfolio_returns).cumprod()
+        st.plotly_chart(px.line(result['normalized_data'], title=f"{title_prefix} - 價格走勢 (標準化)"), use_container_width=True)
 
         st.subheader(f"💼 {title_prefix} - 累積報酬")
-        st.plotly_chart(px.line(cumulative_returns, title=f"{title_prefix} - 累積報酬率"), use_container_width=True)
-
-        total_return = cumulative_returns.iloc[-1] - 1
-        annual_return = total_return / 2 
-        annual_volatility = portfolio_returns.std() * np.sqrt(252)
-        sharpe_ratio = (annual_return - 0.02) / annual_volatility if annual_volatility != 0 else 0
+        st.plotly_chart(px.line(result['cumulative_returns'], title=f"{title_prefix} - 累積報酬率"), use_container_width=True)
 
         st.subheader("📊 績效總覽")
         col1, col2, col3, col4 = st.columns(4)
-        col1.metric("期間總報酬率", f"{total_return:.2%}")
-        col2.metric("年化報酬率", f"{annual_return:.2%}")
-        col3.metric("年化波動率", f"{annual_volatility:.2%}")
-        col4.metric("夏普比率", f"{sharpe_ratio:.2f}")
+        col1.metric("期間總報酬率", f"{result['total_return']:.2%}")
+        col2.metric("年化報酬率", f"{result['annual_return']:.2%}")
+        col3.metric("年化波動率", f"{result['annual_volatility']:.2%}")
+        col4.metric("夏普比率", f"{result['sharpe_ratio']:.2f}")
         st.write("---")
 
         if not is_historical:
             with st.expander("🎲 查看未來10年投資組合風險預測 (蒙地卡羅模擬)"):
-                run_monte_carlo_simulation(portfolio_returns, api_key, tickers)
+                run_monte_carlo_simulation(result['final_values'], result['percentiles'], api_key, tickers)
         else:
             st.subheader("🎲 未來10年投資組合風險預測 (蒙地卡羅模擬)")
-            run_monte_carlo_simulation(portfolio_returns, api_key, tickers)
+            run_monte_carlo_simulation(result['final_values'], result['percentiles'], api_key, tickers)
 
     except Exception as e:
         st.error(f"⚠️ 數據處理或圖表生成失敗: {e}")
 
-def run_monte_carlo_simulation(portfolio_returns, api_key, tickers):
-    with st.spinner("正在執行 1,000 次未來路徑模擬..."):
-        n_simulations, years, initial_investment = 1000, 10, 10000
-        mean_return, std_dev = portfolio_returns.mean(), portfolio_returns.std()
-        simulated_returns = np.random.normal(mean_return, std_dev, (252 * years, n_simulations))
-        final_values = initial_investment * (1 + pd.DataFrame(simulated_returns)).cumprod().iloc[-1]
-        
+def submit_explanation(executor, tickers, percentiles, api_key):
+    """將蒙地卡羅模擬的 AI 解說請求送到背景執行緒，回傳 Future。"""
+    initial_investment = MC_INITIAL_INVESTMENT
+    prompt = f"請以一位親切的理財顧問的身份，用繁體中文、簡單易懂的語言（約150-200字），對一位投資新手解釋以下的「10年期蒙地卡羅模擬」結果。\n\n模擬情境:\n- 投資組合: {tickers}\n- 初始投資: ${initial_investment:,.0f} 美元\n\n模擬結果:\n- 10年後投資價值的中位數: ${percentiles[1]:,.0f} 美元\n- 90%信心區間: ${percentiles[0]:,.0f} 美元至 ${percentiles[2]:,.0f} 美元之間。\n\n請根據以上數據，解釋箱型圖（Box Plot）所代表的意義（它顯示了上千種可能的未來結果），並說明信心區間的實際意涵（未來財富的可能範圍）。最後用一句話總結長期投資的潛力與不確定性。請勿提供任何新的投資建議。"
+    # 背景執行緒中不呼叫 st.*，錯誤由 Future 帶回主執行緒，在原本的位置顯示
+    return executor.submit(_gemini_call_cached, prompt, api_key)
+
+def run_monte_carlo_simulation(final_values, percentiles, api_key, tickers):
+    import plotly.express as px
+    initial_investment = MC_INITIAL_INVESTMENT
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # AI 解說只依賴模擬數值，先在背景送出請求，與圖表繪製同時進行
+        explanation_future = submit_explanation(executor, tickers, percentiles, api_key)
+
         st.subheader("十年後投資價值分佈預測")
-        st.plotly_chart(px.box(y=final_values, points="all", title=f"基於過去數據模擬一萬美元投資十年後的價值分佈"), use_container_width=True)
-        
-        percentiles = np.percentile(final_values, [5, 50, 95])
+        st.plotly_chart(px.box(y=final_values, points="outliers", title=f"基於過去數據模擬一萬美元投資十年後的價值分佈"), use_container_width=True)
+
         st.markdown(f"""
         - **中位數價值 (50% 機率)**: 10 年後，您的 ${initial_investment:,.0f} 投資，有 50% 的機率會成長到 **${percentiles[1]:,.0f}** 美元以上。
         - **90% 信心區間**: 我們有 90% 的信心，10 年後的投資價值會落在 **${percentiles[0]:,.0f}** 美元至 **${percentiles[2]:,.0f}** 美元之間。
         """)
-        
+
         st.subheader("🤖 AI 解說模擬結果")
         with st.spinner("AI 正在為您解讀風險預測圖表..."):
-            prompt = f"請以一位親切的理財顧問的身份，用繁體中文、簡單易懂的語言（約150-200字），對一位投資新手解釋以下的「10年期蒙地卡羅模擬」結果。\n\n模擬情境:\n- 投資組合: {tickers}\n- 初始投資: ${initial_investment:,.0f} 美元\n\n模擬結果:\n- 10年後投資價值的中位數: ${percentiles[1]:,.0f} 美元\n- 90%信心區間: ${percentiles[0]:,.0f} 美元至 ${percentiles[2]:,.0f} 美元之間。\n\n請根據以上數據，解釋箱型圖（Box Plot）所代表的意義（它顯示了上千種可能的未來結果），並說明信心區間的實際意涵（未來財富的可能範圍）。最後用一句話總結長期投資的潛力與不確定性。請勿提供任何新的投資建議。"
-            explanation = get_gemini_recommendation(prompt, api_key)
+            try:
+                explanation = explanation_future.result()
+            except _GeminiCallFailed as e:
+                st.error(str(e))
+                explanation = None
             st.info(explanation or "無法生成 AI 解說。")
 
 # --- 主應用程式路由 ---